@@ -1,13 +1,29 @@
+import asyncio
+import base64
+import calendar
+import hashlib
+import hmac
+import json
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 from typing import Annotated
 from typing import Optional
 from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi.responses import ORJSONResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlmodel import Field, SQLModel, Session, create_engine, select
-from jose import JWTError, jwt  
-from passlib.context import CryptContext
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import Field, SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+import bcrypt
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from cachetools import TTLCache
 
 load_dotenv() # Load variables from the .env file
 
@@ -15,24 +31,75 @@ load_dotenv() # Load variables from the .env file
 SECRET_KEY = os.getenv("SECRET_KEY", "a_default_but_still_secret_key")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Issued tokens are reused until they have less than this many seconds left
+TOKEN_REUSE_MIN_REMAINING = 300
+
+def b64url_encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+# The header and key never change, so they are encoded once instead of per token.
+# Signing below is hard-wired to HMAC-SHA256, so ALGORITHM must stay HS256.
+JWT_HEADER_B64 = b64url_encode(json.dumps({"alg": ALGORITHM, "typ": "JWT"}, separators=(",", ":")).encode())
+JWT_KEY = SECRET_KEY.encode()
+
+# Argon2id cost parameters (memory cost is in KiB)
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "2"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "65536"))
+# Hashing processes per uvicorn worker, lower this when running several workers
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(os.cpu_count() or 1)))
 
 # Security Setup
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+password_hasher = PasswordHasher(
+    time_cost=ARGON2_TIME_COST,
+    memory_cost=ARGON2_MEMORY_COST,
+    parallelism=1,
+)
+
+# Recently verified logins: sha256(username:password) -> the hash it was checked against
+verified_password_cache = TTLCache(maxsize=10000, ttl=60)
+
+# Recently issued access tokens: username -> token
+access_token_cache = TTLCache(
+    maxsize=10000, ttl=ACCESS_TOKEN_EXPIRE_MINUTES * 60 - TOKEN_REUSE_MIN_REMAINING
+)
 
 # Database Setup 
-DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./users.db")
-engine = create_engine(DATABASE_URL, echo=True, connect_args={"check_same_thread": False})
+# Logs every SQL statement when enabled, keep it off outside local debugging
+SQL_ECHO = bool(int(os.getenv("SQL_ECHO", "0")))
+# Only create tables from the app process when explicitly asked to
+AUTO_CREATE_TABLES = os.getenv("AUTO_CREATE_TABLES") == "1"
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite+aiosqlite:///./users.db")
+database_url = make_url(DATABASE_URL)
+engine_kwargs = {}
+if database_url.get_backend_name() == "sqlite":
+    engine_kwargs["connect_args"] = {"check_same_thread": False}
+# In-memory SQLite gets a StaticPool, which doesn't accept pool sizing
+if database_url.database not in (None, "", ":memory:"):
+    # Keep connections open between requests instead of reopening the database
+    engine_kwargs.update(pool_size=10, max_overflow=20)
+engine = create_async_engine(DATABASE_URL, echo=SQL_ECHO, pool_pre_ping=False, **engine_kwargs)
+
+if engine.dialect.name == "sqlite":
+    @event.listens_for(engine.sync_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets readers run concurrently with a writer
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
 
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+async def create_db_and_tables():
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
 
-def get_session():
-    with Session(engine) as session:
+async def get_session():
+    # Objects stay loaded after commit, so responses don't need a refresh query
+    async with AsyncSession(engine, expire_on_commit=False) as session:
         yield session
 
 # Data Models
 class UserBase(SQLModel):
-    username: str
+    username: str = Field(index=True, unique=True)
 
 class UserCreate(UserBase):
     password:str
@@ -46,8 +113,36 @@ class Token(SQLModel):
     token_type: str
 
 # Helper Functions
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+def is_legacy_hash(hashed_password):
+    """Hashes created before the switch to Argon2id are plain bcrypt."""
+    return hashed_password.startswith("$2")
+
+def check_password(plain_password, hashed_password):
+    if is_legacy_hash(hashed_password):
+        return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+    try:
+        return password_hasher.verify(hashed_password, plain_password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def password_cache_key(username, password):
+    return hashlib.sha256(f"{username}:{password}".encode()).digest()
+
+def hash_password(password):
+    return password_hasher.hash(password)
+
+def password_needs_rehash(hashed_password):
+    return is_legacy_hash(hashed_password) or password_hasher.check_needs_rehash(hashed_password)
+
+# Password hashing is CPU-bound, so run it in a process pool to keep it off the
+# event loop and away from the threads FastAPI uses to serve requests
+async def get_password_hash(password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.state.password_pool, hash_password, password)
+
+async def verify_password(plain_password, hashed_password):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app.state.password_pool, check_password, plain_password, hashed_password)
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     to_encode = data.copy()
@@ -55,56 +150,111 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
-    return encoded_jwt
+    to_encode.update({"exp": calendar.timegm(expire.utctimetuple())})
+    # Same compact JSON as python-jose, so tokens are byte-identical
+    signing_input = JWT_HEADER_B64 + b"." + b64url_encode(json.dumps(to_encode, separators=(",", ":")).encode())
+    signature = hmac.new(JWT_KEY, signing_input, hashlib.sha256).digest()
+    return (signing_input + b"." + b64url_encode(signature)).decode()
 
 # FastAPI App 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 @app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
+async def on_startup():
+    # Off by default so workers skip DDL on boot; create the schema once with
+    # `python main.py`, or set AUTO_CREATE_TABLES=1 to do it here (compose does)
+    if AUTO_CREATE_TABLES:
+        await create_db_and_tables()
+
+@app.on_event("startup")
+def open_password_pool():
+    # forkserver avoids forking this process once aiosqlite's threads are running
+    app.state.password_pool = ProcessPoolExecutor(
+        max_workers=PASSWORD_HASH_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver"),
+    )
+
+@app.on_event("shutdown")
+def close_password_pool():
+    app.state.password_pool.shutdown()
 
 # API Endpoints
+@app.get("/health")
+async def health():
+    """Cheap liveness check."""
+    return {"status": "ok"}
+
 @app.post("/users/", response_model=UserBase)
-def create_user(user: UserCreate, session: Session = Depends(get_session)):
+async def create_user(user: UserCreate, session: AsyncSession = Depends(get_session)):
     """Creates a new user account."""
-    existing_user = session.exec(select(User).where(User.username == user.username)).first()
+    existing_user = await session.scalar(select(User).where(User.username == user.username))
     if existing_user:
         raise HTTPException(status_code=400, detail="Username already registered.")
 
-    hashed_password = pwd_context.hash(user.password)
+    hashed_password = await get_password_hash(user.password)
     db_user = User(username=user.username, hashed_password=hashed_password)
 
     session.add(db_user)
-    session.commit()
-    session.refresh(db_user)
+    try:
+        await session.commit()
+    except IntegrityError:
+        # A concurrent request registered the same username after the check above
+        await session.rollback()
+        raise HTTPException(status_code=400, detail="Username already registered.")
 
     return db_user
 
 @app.get("/users/{user_id}", response_model=UserBase)
-def get_user(user_id: int, session: Session = Depends(get_session)):
+async def get_user(user_id: int, session: AsyncSession = Depends(get_session)):
     """Gets a specific user by their ID."""
-    user = session.get(User, user_id)
+    user = await session.get(User, user_id)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     return user
 
 @app.post("/token", response_model=Token)
-def login_for_access_token(
+async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
-    user = session.exec(select(User).where(User.username == form_data.username)).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    user = await session.scalar(select(User).where(User.username == form_data.username))
+    password_ok = False
+    if user:
+        # A cached entry only counts if the stored hash hasn't changed since it was verified
+        cache_key = password_cache_key(user.username, form_data.password)
+        password_ok = verified_password_cache.get(cache_key) == user.hashed_password
+        if not password_ok:
+            password_ok = await verify_password(form_data.password, user.hashed_password)
+            if password_ok:
+                verified_password_cache[cache_key] = user.hashed_password
+    if not password_ok:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
-    return {"access_token": access_token, "token_type": "bearer"}
\ No newline at end of file
+    access_token = access_token_cache.get(user.username)
+    if access_token is None:
+        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+        access_token = create_access_token(
+            data={"sub": user.username}, expires_delta=access_token_expires
+        )
+        access_token_cache[user.username] = access_token
+
+    # Upgrade legacy bcrypt hashes and hashes made with older Argon2 parameters
+    if password_needs_rehash(user.hashed_password):
+        new_hash = await get_password_hash(form_data.password)
+        user.hashed_password = new_hash
+        verified_password_cache[cache_key] = new_hash
+        session.add(user)
+        await session.commit()
+
+    return {"access_token": access_token, "token_type": "bearer"}
+
+async def create_tables_once():
+    await create_db_and_tables()
+    await engine.dispose()
+
+if __name__ == "__main__":
+    # One-shot schema setup: python main.py
+    asyncio.run(create_tables_once())
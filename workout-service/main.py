@@ -1,10 +1,15 @@
-import requests
+import hashlib
 import os
+import time
 from dotenv import load_dotenv
 from typing import Optional, Annotated
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, status
+from fastapi.responses import ORJSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from jose import JWTError, jwt
+import jwt
+from jwt import InvalidTokenError
+from cachetools import TTLCache
+from sqlalchemy import event
 from sqlmodel import Field, SQLModel, Session, create_engine, select
 
 load_dotenv() # Load the .env file
@@ -15,14 +20,36 @@ ALGORITHM = "HS256"
 # Looks for our token
 security_scheme = HTTPBearer()
 
+# Recently validated tokens: truncated sha256(token) -> (username, exp)
+validated_token_cache = TTLCache(maxsize=10000, ttl=60)
+
 # Database Setup
-engine = create_engine("sqlite:///./workouts.db", echo=True, connect_args={"check_same_thread": False})
+# Logs every SQL statement when enabled, keep it off outside local debugging
+SQL_ECHO = bool(int(os.getenv("SQL_ECHO", "0")))
+engine = create_engine(
+    "sqlite:///./workouts.db",
+    echo=SQL_ECHO,
+    connect_args={"check_same_thread": False},
+    # Keep connections open between requests instead of reopening the database
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=False,
+)
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers run concurrently with a writer
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
 
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
 
 def get_session():
-    with Session(engine) as session:
+    # Objects stay loaded after commit, so responses don't need a refresh query
+    with Session(engine, expire_on_commit=False) as session:
         yield session
 
 # Data Models
@@ -39,44 +66,49 @@ class WorkoutCreate(WorkoutBase):
 
 class Workout(WorkoutBase, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
-    owner_username: str # Stores owner's username
+    owner_username: str = Field(index=True) # Stores owner's username
+
+# Off by default so workers skip DDL on import; create the schema once with
+# `python main.py`, or set AUTO_CREATE_TABLES=1 to do it here (compose does)
+if os.getenv("AUTO_CREATE_TABLES") == "1":
+    create_db_and_tables()
 
 # Helper Funtions
-def user_exists(user_id: int) -> bool:
-    """Checks if a user exists by calling the user-service."""
-    try:
-        response = requests.get(f"http://127.0.0.1:8000/users/{user_id}")
-        # Return True if the user-service says "OK" (status code 200)
-        return response.status_code == 200
-    except requests.ConnectionError:
-        # In case we can't connect to the user-service at all
-        return False
-    
-def get_current_user(token: HTTPAuthorizationCredentials = Depends(security_scheme)):
+async def get_current_user(token: HTTPAuthorizationCredentials = Depends(security_scheme)):
     """Decodes the token to get the current user."""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    cache_key = hashlib.sha256(token.credentials.encode()).digest()[:16]
+    cached = validated_token_cache.get(cache_key)
+    if cached is not None:
+        username, exp = cached
+        # The cache TTL can outlive the token itself, so re-check expiry
+        if time.time() > exp:
+            raise credentials_exception
+        return username
+
     try:
         # Use token.credentials to get the raw string
-        payload = jwt.decode(token.credentials, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-    except JWTError:
+        payload = jwt.decode(
+            token.credentials,
+            SECRET_KEY,
+            algorithms=[ALGORITHM],
+            options={"require": ["exp", "sub"]},
+        )
+        username: str = payload["sub"]
+    except InvalidTokenError:
         raise credentials_exception
+
+    validated_token_cache[cache_key] = (username, payload["exp"])
     
     # If the wristband is valid, the bouncer returns the username
     return username
 
 # FastAPI App
-app = FastAPI()
-
-@app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
+app = FastAPI(default_response_class=ORJSONResponse)
 
 # API Endpoints
 @app.post("/workouts/", response_model=Workout)
@@ -98,18 +130,27 @@ def create_workout(
 
     session.add(db_workout)
     session.commit()
-    session.refresh(db_workout)
     return db_workout
 
 @app.get("/workouts/", response_model=list[Workout])
 def get_workouts(
+    limit: int = Query(default=50, ge=1, le=500),
+    cursor: Optional[int] = None,
     session: Session = Depends(get_session),
     current_user: str = Depends(get_current_user) 
     ):
-    """Gets all workouts for the currently logged-in user."""
+    """Gets a page of workouts for the currently logged-in user."""
 
-    # Query to filter by the owner
+    # Query to filter by the owner, one page at a time ordered by id.
+    # Pass the last id of a page as the cursor to get the next one.
     statement = select(Workout).where(Workout.owner_username == current_user)
+    if cursor is not None:
+        statement = statement.where(Workout.id > cursor)
+    statement = statement.order_by(Workout.id).limit(limit)
     results = session.exec(statement)
     workouts = results.all()
-    return workouts
\ No newline at end of file
+    return workouts
+
+if __name__ == "__main__":
+    # One-shot schema setup: python main.py
+    create_db_and_tables()